@@ -1,18 +1,28 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, status, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from motor.motor_asyncio import AsyncIOMotorClient
 from google.cloud import documentai_v1 as documentai
 from google.oauth2 import service_account
+from google.api_core.exceptions import NotFound
 import google.generativeai as genai
+from google.generativeai import caching
 import os
-from datetime import datetime
-from typing import List, Dict
+import math
+import asyncio
+import hashlib
+import gzip
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Optional, Tuple
 import logging
 from dotenv import load_dotenv
-import json
+import orjson
 import aiosmtplib
 from email.message import EmailMessage
-from bson import ObjectId
+from bson import ObjectId, Binary
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
 from fastapi.middleware.cors import CORSMiddleware
 # Load environment variables from .env file
 load_dotenv()
@@ -22,7 +32,7 @@ logging.basicConfig(level=logging.INFO)  # Set root logger to INFO
 logger = logging.getLogger("main")  # Use a specific logger for your app
 
 # Initialize FastAPI app
-app = FastAPI(title="kko-backend", version="1.0.0")
+app = FastAPI(title="kko-backend", version="1.0.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,21 +46,75 @@ app.add_middleware(
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "kko_db")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "summaries")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 10))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd,snappy,zlib")
 GOOGLE_GEMINI_KEY = os.getenv("GOOGLE_GEMINI_KEY")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
 GOOGLE_PROJECT_ID = os.getenv("GOOGLE_PROJECT_ID")
 DOCUMENT_AI_LOCATION = os.getenv("DOCUMENT_AI_LOCATION", "us")
 DOCUMENT_AI_PROCESSOR_ID = os.getenv("DOCUMENT_AI_PROCESSOR_ID")
+PROCESSOR_NAME = f"projects/{GOOGLE_PROJECT_ID}/locations/{DOCUMENT_AI_LOCATION}/processors/{DOCUMENT_AI_PROCESSOR_ID}"
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+CHAT_CACHE_COLLECTION = os.getenv("CHAT_CACHE_COLLECTION", "chat_cache")
+CHAT_CACHE_EMBEDDING_MODEL = os.getenv("CHAT_CACHE_EMBEDDING_MODEL", "models/gemini-embedding-001")
+CHAT_CACHE_EMBEDDING_DIMENSIONS = int(os.getenv("CHAT_CACHE_EMBEDDING_DIMENSIONS", 768))
+CHAT_CACHE_SIMILARITY = float(os.getenv("CHAT_CACHE_SIMILARITY", 0.95))
+CHAT_CACHE_TTL_SECONDS = int(os.getenv("CHAT_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+CHAT_CACHE_LRU_SIZE = int(os.getenv("CHAT_CACHE_LRU_SIZE", 256))
+CHAT_CACHE_MAX_CANDIDATES = int(os.getenv("CHAT_CACHE_MAX_CANDIDATES", 50))
+# Explicit Gemini context caching for /chat; it needs a versioned model and a minimum prompt size
+CHAT_CONTEXT_CACHE_MODEL = os.getenv("CHAT_CONTEXT_CACHE_MODEL", "models/gemini-2.0-flash-001")
+CHAT_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CHAT_CONTEXT_CACHE_MIN_TOKENS", 4096))
+CHAT_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CHAT_CONTEXT_CACHE_TTL_SECONDS", 60 * 60))
+CHAT_CONTEXT_CACHE_SIZE = int(os.getenv("CHAT_CONTEXT_CACHE_SIZE", 32))
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", 12000))
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 8000))
+CHARS_PER_TOKEN = 4  # Rough estimate for English text
+MAX_REDUCE_ROUNDS = 3
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 4))
+MAX_PDF_BYTES = int(os.getenv("MAX_PDF_BYTES", 25 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 50))
+INSERT_FLUSH_INTERVAL = float(os.getenv("INSERT_FLUSH_INTERVAL", 0))
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", 20))
+EMAIL_BATCH_TIMEOUT = float(os.getenv("EMAIL_BATCH_TIMEOUT", 0.2))
+# The in-memory email worker only suits long-lived uvicorn processes; serverless hosts
+# (e.g. Vercel) may freeze or recycle the instance after the response and drop queued emails
+EMAIL_WORKER_ENABLED = os.getenv("EMAIL_WORKER_ENABLED", "false").lower() in ("1", "true", "yes")
 
 # Global variables for clients
 mongo_client = None
 documentai_client = None
 gemini_model = None
 
+# Queue of documents waiting to be bulk-inserted, drained by a background task
+insert_queue = None
+insert_flush_task = None
+# Uploads currently being processed, keyed by content_hash; duplicates await the first upload's result
+inflight_uploads: Dict[str, asyncio.Future] = {}
+
+# Queue of outgoing emails consumed by a long-lived worker, with one SMTP session per host
+email_queue = None
+email_worker_task = None
+smtp_clients: Dict[str, aiosmtplib.SMTP] = {}
+# Serializes use of each host's session, since background tasks from concurrent uploads share it
+smtp_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Bounds concurrent Gemini calls when long documents are analyzed chunk by chunk
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# In-process LRU of exact (mongo_id, normalized question) -> answer hits
+chat_answer_lru: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+# In-process LRU of mongo_id -> (document's Gemini context cache, model bound to it, local expiry)
+chat_context_models: "OrderedDict[str, Tuple[caching.CachedContent, genai.GenerativeModel, datetime]]" = OrderedDict()
+# Context caches being created, keyed by mongo_id; concurrent questions await the same creation
+inflight_context_models: Dict[str, asyncio.Task] = {}
+
 # Pydantic models
 class SummaryResponse(BaseModel):
     filename: str
@@ -68,23 +132,40 @@ class ChatResponse(BaseModel):
 # Startup event to initialize clients
 @app.on_event("startup")
 async def startup_event():
-    global mongo_client, documentai_client, gemini_model
+    global mongo_client, documentai_client, gemini_model, insert_queue, insert_flush_task
+    global email_queue, email_worker_task
     try:
         # Initialize MongoDB client
-        mongo_client = AsyncIOMotorClient(MONGO_URI)
+        mongo_client = AsyncIOMotorClient(
+            MONGO_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            serverSelectionTimeoutMS=3000,
+            socketTimeoutMS=10000,
+            retryWrites=True,
+            compressors=MONGO_COMPRESSORS
+        )
         await mongo_client.server_info()
         logger.info("MongoDB connection established")
 
+        await ensure_indexes()
+        logger.info("MongoDB indexes ensured")
+
+        # Start the background task that batches document inserts
+        insert_queue = asyncio.Queue()
+        insert_flush_task = asyncio.create_task(flush_inserts_loop())
+        logger.info("Insert flush task started")
+
         # Initialize Google Cloud Document AI client
         if not GOOGLE_CREDENTIALS_JSON or not GOOGLE_PROJECT_ID or not DOCUMENT_AI_PROCESSOR_ID:
             raise ValueError("GOOGLE_CREDENTIALS_JSON, GOOGLE_PROJECT_ID, or DOCUMENT_AI_PROCESSOR_ID not set in .env")
         
         try:
-            creds_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
+            creds_dict = orjson.loads(GOOGLE_CREDENTIALS_JSON)
             credentials = service_account.Credentials.from_service_account_info(creds_dict)
             documentai_client = documentai.DocumentProcessorServiceClient(credentials=credentials)
             logger.info("Google Document AI client initialized")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             raise ValueError(f"Invalid GOOGLE_CREDENTIALS_JSON format: {str(e)}")
         except Exception as e:
             raise ValueError(f"Failed to initialize Google Document AI client: {str(e)}")
@@ -101,6 +182,13 @@ async def startup_event():
             raise ValueError("SMTP_USER, SMTP_PASSWORD, or SMTP_SERVER not set in .env")
         logger.info("SMTP configuration loaded")
 
+        # Optionally start the background worker that batches outgoing emails;
+        # otherwise emails are sent by a BackgroundTask within each upload request
+        if EMAIL_WORKER_ENABLED:
+            email_queue = asyncio.Queue()
+            email_worker_task = asyncio.create_task(email_worker())
+            logger.info("Email worker started")
+
     except Exception as e:
         logger.error(f"Startup error: {str(e)}")
         raise HTTPException(
@@ -108,23 +196,169 @@ async def startup_event():
             detail=f"Failed to initialize services: {str(e)}"
         )
 
-# Helper function to extract text from PDF using Google Document AI
-async def extract_text_from_pdf(file_content: bytes) -> str:
+# Helper function to create the MongoDB indexes the app relies on (idempotent)
+async def ensure_indexes():
+    collection = mongo_client[DB_NAME][COLLECTION_NAME]
+    chat_cache = mongo_client[DB_NAME][CHAT_CACHE_COLLECTION]
+    await asyncio.gather(
+        # Newest-first sort and (timestamp, _id) keyset pagination in /all
+        collection.create_index([("timestamp", -1), ("_id", -1)]),
+        # Duplicate-upload lookups; sparse so documents without a hash are not indexed
+        collection.create_index("content_hash", unique=True, sparse=True),
+        # Chat cache lookups by document, and expiry of stale entries
+        chat_cache.create_index([("mongo_id", 1), ("embedding_model", 1), ("created_at", -1)]),
+        chat_cache.create_index("created_at", expireAfterSeconds=CHAT_CACHE_TTL_SECONDS)
+    )
+
+# Helper function to collect up to max_items from a queue: everything already queued, then whatever
+# arrives within timeout seconds of the first item (a timeout of 0 never waits)
+async def drain_queue(queue: asyncio.Queue, max_items: int, timeout: float) -> list:
+    items = [await queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while len(items) < max_items:
+        if not queue.empty():
+            items.append(queue.get_nowait())
+            continue
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return items
+
+# Helper function to write a batch of documents in a single round-trip, resolving each caller's future
+async def flush_inserts(batch: List[Tuple[dict, asyncio.Future]]):
+    errors: Dict[int, Exception] = {}
     try:
-        # Construct the processor resource name
-        processor_name = f"projects/{GOOGLE_PROJECT_ID}/locations/{DOCUMENT_AI_LOCATION}/processors/{DOCUMENT_AI_PROCESSOR_ID}"
+        collection = mongo_client[DB_NAME][COLLECTION_NAME]
+        await collection.bulk_write([InsertOne(document) for document, _ in batch], ordered=False)
+        logger.info(f"Inserted {len(batch)} documents")
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        logger.error(f"Failed to insert {len(write_errors) or len(batch)} of {len(batch)} documents: {str(e)}")
+        for error in write_errors:
+            error_class = DuplicateKeyError if error.get("code") == 11000 else WriteError
+            errors[error["index"]] = error_class(error.get("errmsg"), error.get("code"), error)
+        if not write_errors:
+            errors = {index: e for index in range(len(batch))}
+    except Exception as e:
+        logger.error(f"Failed to insert {len(batch)} documents: {str(e)}")
+        errors = {index: e for index in range(len(batch))}
+
+    for index, (document, future) in enumerate(batch):
+        if future.done():
+            continue
+        if index in errors:
+            future.set_exception(errors[index])
+        else:
+            future.set_result(document["_id"])
+
+# Background task draining the insert queue; a None entry stops it after flushing
+async def flush_inserts_loop():
+    while True:
+        batch = await drain_queue(insert_queue, INSERT_BATCH_SIZE, INSERT_FLUSH_INTERVAL)
+        stop = None in batch
+        batch = [entry for entry in batch if entry is not None]
+        if batch:
+            await flush_inserts(batch)
+        if stop:
+            return
+
+# Helper function to persist a document, batching through the insert queue when it is running.
+# Waits until the document's batch has been written so failures reach the caller.
+async def save_document(document: dict) -> ObjectId:
+    document["_id"] = ObjectId()
+    if insert_flush_task and not insert_flush_task.done():
+        future = asyncio.get_running_loop().create_future()
+        await insert_queue.put((document, future))
+        return await future
+    await mongo_client[DB_NAME][COLLECTION_NAME].insert_one(document)
+    return document["_id"]
 
-        # Create RawDocument for Document AI
-        raw_document = documentai.RawDocument(content=file_content, mime_type="application/pdf")
+# Helper function to find a stored upload with the same content hash, or claim the hash for processing.
+# Returns (existing_document, None) for duplicates, or (None, claim) when the caller must process the upload.
+async def claim_upload(content_hash: str) -> Tuple[Optional[dict], Optional[asyncio.Future]]:
+    collection = mongo_client[DB_NAME][COLLECTION_NAME]
+    while True:
+        inflight = inflight_uploads.get(content_hash)
+        if inflight is not None:
+            document = await asyncio.shield(inflight)
+            if document is not None:
+                return document, None
+            # The earlier upload failed; look again and possibly claim the hash ourselves
+            continue
 
-        # Create ProcessRequest
+        document = await collection.find_one(
+            {"content_hash": content_hash},
+            projection={"summary": 1, "departments": 1}
+        )
+        if document is not None:
+            return document, None
+        # Another request may have claimed the hash while the lookup was in flight
+        if content_hash not in inflight_uploads:
+            claim = asyncio.get_running_loop().create_future()
+            inflight_uploads[content_hash] = claim
+            return None, claim
+
+# Helper function to release a claimed content hash, waking duplicates with the result (None on failure)
+def release_upload(content_hash: str, claim: asyncio.Future, document: Optional[dict] = None):
+    if not claim.done():
+        claim.set_result(document)
+    if inflight_uploads.get(content_hash) is claim:
+        del inflight_uploads[content_hash]
+
+# Helper function to build the /upload response for a previously processed document
+def reused_upload_response(filename: str, document: dict) -> ORJSONResponse:
+    logger.info(f"Duplicate upload of {filename}, reusing document {document['_id']}")
+    return ORJSONResponse({
+        "filename": filename,
+        "departments": document["departments"],
+        "summary": document["summary"],
+        "mongo_id": str(document["_id"])
+    })
+
+# Helper function to read an uploaded file in chunks, rejecting it once it exceeds MAX_PDF_BYTES
+async def read_upload(file: UploadFile) -> bytes:
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File exceeds maximum size of {MAX_PDF_BYTES // (1024 * 1024)} MB"
+    )
+    if file.size is not None and file.size > MAX_PDF_BYTES:
+        raise too_large
+
+    chunks = []
+    total = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        total += len(chunk)
+        if total > MAX_PDF_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# Helper function to gzip extracted text for storage; CPU-bound, so call it via asyncio.to_thread
+def compress_text(text: str) -> Binary:
+    return Binary(gzip.compress(text.encode("utf-8"), compresslevel=6))
+
+# Helper function to read a document's extracted text, whether stored compressed or as plain text;
+# decompression is CPU-bound, so call it via asyncio.to_thread
+def get_extracted_text(document: dict) -> str:
+    if document.get("extracted_text_gz") is not None:
+        return gzip.decompress(document["extracted_text_gz"]).decode("utf-8")
+    return document.get("extracted_text", "")
+
+# Helper function to extract text from PDF using Google Document AI
+async def extract_text_from_pdf(file_content: bytes) -> str:
+    try:
         request = documentai.ProcessRequest(
-            name=processor_name,
-            raw_document=raw_document
+            name=PROCESSOR_NAME,
+            raw_document=documentai.RawDocument(content=file_content, mime_type="application/pdf")
         )
 
-        # Process the document
-        response = documentai_client.process_document(request=request)
+        # Process the document on a worker thread; the client is synchronous gRPC
+        response = await asyncio.to_thread(documentai_client.process_document, request=request)
         document = response.document
 
         # Extract text
@@ -139,8 +373,8 @@ async def extract_text_from_pdf(file_content: bytes) -> str:
             detail=f"Failed to extract text from PDF: {str(e)}"
         )
 
-# Helper function to process text with Google Gemini Flash 2.0
-async def process_with_gemini(text: str) -> tuple[str, List[Dict[str, str]]]:
+# Helper function to process a single prompt-sized text with Google Gemini Flash 2.0
+async def analyze_text_with_gemini(text: str) -> tuple[str, List[Dict[str, str]]]:
     try:
         prompt = f"""
         Analyze the following text extracted from a PDF document:
@@ -163,7 +397,7 @@ async def process_with_gemini(text: str) -> tuple[str, List[Dict[str, str]]]:
         ```
         """
         
-        response = gemini_model.generate_content(prompt)
+        response = await gemini_model.generate_content_async(prompt)
         result = response.text
         
         # Extract JSON from the response (remove markdown code blocks if present)
@@ -173,8 +407,8 @@ async def process_with_gemini(text: str) -> tuple[str, List[Dict[str, str]]]:
             result = result.split("```")[1].split("```")[0].strip()
         
         try:
-            parsed_result = json.loads(result)
-        except json.JSONDecodeError as e:
+            parsed_result = orjson.loads(result)
+        except orjson.JSONDecodeError as e:
             logger.error(f"Failed to parse Gemini response as JSON: {result}, error: {str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -209,23 +443,134 @@ async def process_with_gemini(text: str) -> tuple[str, List[Dict[str, str]]]:
             detail=f"Failed to process text with Google Gemini: {str(e)}"
         )
 
+# Helper function to split text into chunks of roughly max_tokens, breaking on whitespace where possible
+def split_text(text: str, max_tokens: int) -> List[str]:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + max_chars
+        if end < len(text):
+            boundary = max(text.rfind("\n", start, end), text.rfind(" ", start, end))
+            if boundary > start:
+                end = boundary
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+# Helper function to analyze one chunk of a long document, bounded by gemini_semaphore
+async def analyze_chunk_with_gemini(chunk: str) -> tuple[str, List[Dict[str, str]]]:
+    async with gemini_semaphore:
+        return await analyze_text_with_gemini(chunk)
+
+# Helper function to analyze chunks concurrently, cancelling the remaining calls as soon as one fails
+async def analyze_chunks_with_gemini(chunks: List[str]) -> List[tuple[str, List[Dict[str, str]]]]:
+    tasks = [asyncio.create_task(analyze_chunk_with_gemini(chunk)) for chunk in chunks]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+# Helper function to pack texts into groups of at most max_tokens, splitting any text that is too long alone
+def group_texts(texts: List[str], max_tokens: int) -> List[str]:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    groups = []
+    current, size = [], 0
+    for text in texts:
+        for piece in split_text(text, max_tokens):
+            if current and size + len(piece) + 2 > max_chars:
+                groups.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 2
+    if current:
+        groups.append("\n\n".join(current))
+    return groups
+
+# Helper function to summarize text with Google Gemini, map-reducing texts too long for one prompt
+async def process_with_gemini(text: str) -> tuple[str, List[Dict[str, str]]]:
+    max_chars = MAX_PROMPT_TOKENS * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return await analyze_text_with_gemini(text)
+
+    chunks = split_text(text, CHUNK_TOKENS)
+    logger.info(f"Text of {len(text)} characters split into {len(chunks)} chunks for Gemini")
+    results = await analyze_chunks_with_gemini(chunks)
+    all_departments = [d for _, chunk_departments in results for d in chunk_departments]
+    summaries = [chunk_summary for chunk_summary, _ in results]
+
+    # Summarize the summaries in prompt-sized groups until they fit in a single reduce prompt
+    for _ in range(MAX_REDUCE_ROUNDS):
+        if len("\n\n".join(summaries)) <= max_chars:
+            break
+        results = await analyze_chunks_with_gemini(group_texts(summaries, CHUNK_TOKENS))
+        all_departments += [d for _, group_departments in results for d in group_departments]
+        summaries = [group_summary for group_summary, _ in results]
+
+    joined = "\n\n".join(summaries)
+    if len(joined) > max_chars:
+        logger.warning(f"Chunk summaries still {len(joined)} characters after {MAX_REDUCE_ROUNDS} rounds, truncating")
+        joined = joined[:max_chars]
+
+    # Reduce the summaries into one; departments are merged across all calls
+    summary, reduced_departments = await analyze_text_with_gemini(joined)
+
+    departments = []
+    seen = set()
+    for dept in all_departments + reduced_departments:
+        key = (str(dept["name"]).strip().lower(), dept["email"])
+        if key not in seen:
+            seen.add(key)
+            departments.append(dept)
+    return summary, departments
+
 # Helper function to prepare email data
 def prepare_email_data(departments: List[Dict[str, str]], summary: str, filename: str) -> List[dict]:
-    email_list = []
-    for dept in departments:
-        if dept.get("email"):
-            email_list.append({
-                "department": dept["name"],
-                "summary": summary,
-                "subject": f"Notice Summary for {dept['name']}: {filename}",
-                "to": dept["email"]
-            })
-    return email_list
+    return [
+        {
+            "department": dept["name"],
+            "summary": summary,
+            "subject": f"Notice Summary for {dept['name']}: {filename}",
+            "to": dept["email"]
+        }
+        for dept in departments
+        if dept.get("email")
+    ]
 
-# Helper function to send emails asynchronously
-async def send_emails_async(email_data: List[Dict[str, str]]):
-    if not email_data:
-        logger.warning("No emails to send.")
+# Helper function to open an authenticated SMTP session
+async def open_smtp_connection(hostname: str) -> aiosmtplib.SMTP:
+    smtp = aiosmtplib.SMTP(hostname=hostname, port=SMTP_PORT, start_tls=False)
+    await smtp.connect()
+    await smtp.starttls()
+    await smtp.login(SMTP_USER, SMTP_PASSWORD)
+    return smtp
+
+# Helper function to return the shared SMTP session for a host, reconnecting if it went stale
+async def get_smtp_connection(hostname: str) -> aiosmtplib.SMTP:
+    smtp = smtp_clients.get(hostname)
+    if smtp is not None and smtp.is_connected:
+        try:
+            await smtp.noop()
+            return smtp
+        except aiosmtplib.SMTPException as e:
+            logger.warning(f"SMTP connection to {hostname} went stale, reconnecting: {str(e)}")
+    smtp = smtp_clients[hostname] = await open_smtp_connection(hostname)
+    return smtp
+
+# Helper function to send emails for one host sequentially over its shared SMTP session
+async def send_email_group(hostname: str, email_data: List[Dict[str, str]]):
+    async with smtp_locks[hostname]:
+        await send_email_group_locked(hostname, email_data)
+
+# Helper function to send emails for one host; callers must hold smtp_locks[hostname]
+async def send_email_group_locked(hostname: str, email_data: List[Dict[str, str]]):
+    try:
+        smtp = await get_smtp_connection(hostname)
+    except Exception as e:
+        logger.error(f"Failed to connect to SMTP server {hostname}: {str(e)}")
         return
 
     for email_entry in email_data:
@@ -236,45 +581,243 @@ async def send_emails_async(email_data: List[Dict[str, str]]):
         msg.set_content(email_entry["summary"])
 
         try:
-            await aiosmtplib.send(
-                msg,
-                hostname=SMTP_SERVER,
-                port=SMTP_PORT,
-                start_tls=True,
-                username=SMTP_USER,
-                password=SMTP_PASSWORD,
-            )
+            try:
+                await smtp.send_message(msg)
+            except aiosmtplib.SMTPServerDisconnected:
+                # Server dropped the session; reconnect once and retry
+                logger.warning(f"SMTP connection to {hostname} lost, reconnecting")
+                smtp = await get_smtp_connection(hostname)
+                await smtp.send_message(msg)
             logger.info(f"Email sent to {email_entry['to']} ({email_entry['department']})")
         except Exception as e:
             logger.error(f"Failed to send email to {email_entry['to']}: {str(e)}")
 
+# Helper function to send emails asynchronously, one concurrent session per SMTP host
+async def send_emails_async(email_data: List[Dict[str, str]]):
+    if not email_data:
+        logger.warning("No emails to send.")
+        return
+
+    groups = defaultdict(list)
+    for email_entry in email_data:
+        groups[email_entry.get("smtp_host", SMTP_SERVER)].append(email_entry)
+    await asyncio.gather(*(send_email_group(hostname, entries) for hostname, entries in groups.items()))
+
+# Background task batching queued emails over the shared SMTP sessions; a None entry stops it
+async def email_worker():
+    while True:
+        email_data = await drain_queue(email_queue, EMAIL_BATCH_SIZE, EMAIL_BATCH_TIMEOUT)
+        stop = None in email_data
+        email_data = [email_entry for email_entry in email_data if email_entry is not None]
+        if email_data:
+            await send_emails_async(email_data)
+        if stop:
+            return
+
+# Helper function to hand emails to the worker when EMAIL_WORKER_ENABLED, otherwise to a background task
+def queue_emails(email_data: List[Dict[str, str]], background_tasks: Optional[BackgroundTasks]):
+    if email_worker_task and not email_worker_task.done():
+        for email_entry in email_data:
+            email_queue.put_nowait(email_entry)
+    elif background_tasks:
+        background_tasks.add_task(send_emails_async, email_data)
+
+# Helper function to normalize a question for cache keys
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+# Helper function to identify the embedding space stored with each chat cache entry
+def embedding_model_key() -> str:
+    return f"{CHAT_CACHE_EMBEDDING_MODEL}:{CHAT_CACHE_EMBEDDING_DIMENSIONS}"
+
+# Helper function to embed a question as a unit-length vector with Google Gemini
+async def embed_question(question: str) -> List[float]:
+    result = await genai.embed_content_async(
+        model=CHAT_CACHE_EMBEDDING_MODEL,
+        content=question,
+        task_type="semantic_similarity",
+        output_dimensionality=CHAT_CACHE_EMBEDDING_DIMENSIONS
+    )
+    embedding = result["embedding"]
+    norm = math.sqrt(sum(x * x for x in embedding))
+    return [x / norm for x in embedding] if norm else embedding
+
+# Helper function to record an answer in the in-process LRU
+def remember_answer(key: Tuple[str, str], answer: str):
+    chat_answer_lru[key] = answer
+    chat_answer_lru.move_to_end(key)
+    while len(chat_answer_lru) > CHAT_CACHE_LRU_SIZE:
+        chat_answer_lru.popitem(last=False)
+
+# Helper function to return an exact-match answer from the in-process LRU
+def recall_answer(key: Tuple[str, str]) -> Optional[str]:
+    answer = chat_answer_lru.get(key)
+    if answer is not None:
+        chat_answer_lru.move_to_end(key)
+    return answer
+
+# Helper function to pick the most similar cached entry; CPU-bound, so call it via asyncio.to_thread
+def best_cached_match(embedding: List[float], entries: List[dict]) -> Tuple[Optional[str], float]:
+    best_answer, best_score = None, CHAT_CACHE_SIMILARITY
+    for entry in entries:
+        # Stored embeddings are unit-length, so the dot product is the cosine similarity
+        score = sum(a * b for a, b in zip(embedding, entry["q_embedding"]))
+        if score >= best_score:
+            best_answer, best_score = entry["answer"], score
+    return best_answer, best_score
+
+# Helper function to look up a cached answer for a semantically similar question
+async def get_cached_answer(mongo_id: str, normalized_question: str) -> Tuple[Optional[str], Optional[List[float]]]:
+    try:
+        embedding = await embed_question(normalized_question)
+        chat_cache = mongo_client[DB_NAME][CHAT_CACHE_COLLECTION]
+        entries = await chat_cache.find(
+            # Only compare against vectors from the same model and size
+            {"mongo_id": mongo_id, "embedding_model": embedding_model_key()},
+            projection={"q_embedding": 1, "answer": 1, "_id": 0}
+        ).sort("created_at", -1).to_list(CHAT_CACHE_MAX_CANDIDATES)
+
+        best_answer, best_score = await asyncio.to_thread(best_cached_match, embedding, entries)
+        if best_answer is not None:
+            logger.info(f"Chat cache hit for mongo_id {mongo_id} (similarity {best_score:.3f})")
+            remember_answer((mongo_id, normalized_question), best_answer)
+        return best_answer, embedding
+    except Exception as e:
+        logger.warning(f"Chat cache lookup failed: {str(e)}")
+        return None, None
+
+# Helper function to store a freshly generated answer in the chat cache
+async def cache_answer(mongo_id: str, question: str, embedding: Optional[List[float]], answer: str):
+    normalized = normalize_question(question)
+    remember_answer((mongo_id, normalized), answer)
+    if embedding is None:
+        return
+
+    try:
+        chat_cache = mongo_client[DB_NAME][CHAT_CACHE_COLLECTION]
+        await chat_cache.insert_one({
+            "mongo_id": mongo_id,
+            "question": normalized,
+            "q_embedding": embedding,
+            "embedding_model": embedding_model_key(),
+            "answer": answer,
+            "created_at": datetime.now(timezone.utc)
+        })
+    except Exception as e:
+        logger.warning(f"Failed to store chat cache entry: {str(e)}")
+
+# Helper function to return a document's context-cached model from the in-process LRU
+def recall_context_model(mongo_id: str) -> Optional[genai.GenerativeModel]:
+    entry = chat_context_models.get(mongo_id)
+    if entry is None:
+        return None
+    _, model, expires_at = entry
+    if expires_at <= datetime.now(timezone.utc):
+        del chat_context_models[mongo_id]
+        return None
+    chat_context_models.move_to_end(mongo_id)
+    return model
+
+# Helper function to delete Gemini context caches evicted from the in-process LRU
+async def delete_context_caches(cached_contents: List[caching.CachedContent]):
+    for cached_content in cached_contents:
+        try:
+            await asyncio.to_thread(cached_content.delete)
+        except Exception as e:
+            logger.warning(f"Failed to delete Gemini context cache {cached_content.name}: {str(e)}")
+
+# Helper function to record a context-cached model, deleting the caches it evicts
+async def remember_context_model(mongo_id: str, cached_content: caching.CachedContent, model: genai.GenerativeModel):
+    # Expire locally a minute early so a cache is never used right as Gemini drops it
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=max(CHAT_CONTEXT_CACHE_TTL_SECONDS - 60, 0))
+    chat_context_models[mongo_id] = (cached_content, model, expires_at)
+    chat_context_models.move_to_end(mongo_id)
+    evicted = []
+    while len(chat_context_models) > CHAT_CONTEXT_CACHE_SIZE:
+        evicted.append(chat_context_models.popitem(last=False)[1][0])
+    await delete_context_caches(evicted)
+
+# Helper function to build a Gemini model carrying the document as its system instruction
+async def build_document_model(mongo_id: str, document: dict) -> genai.GenerativeModel:
+    summary = document.get("summary", "")
+    extracted_text = await asyncio.to_thread(get_extracted_text, document)
+    system_instruction = (
+        "Using the following document summary and extracted text, answer questions about the document.\n\n"
+        f"Summary: {summary}\n"
+        f"Extracted Text: {extracted_text}\n\n"
+        "Provide a clear, concise answer (20–30 words) in plain text."
+    )
+
+    # Gemini refuses context caches below its minimum size, so short documents are sent inline
+    if len(system_instruction) // CHARS_PER_TOKEN >= CHAT_CONTEXT_CACHE_MIN_TOKENS:
+        try:
+            cached_content = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=CHAT_CONTEXT_CACHE_MODEL,
+                display_name=f"kko-{mongo_id}",
+                system_instruction=system_instruction,
+                ttl=timedelta(seconds=CHAT_CONTEXT_CACHE_TTL_SECONDS)
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+            await remember_context_model(mongo_id, cached_content, model)
+            logger.info(f"Created Gemini context cache {cached_content.name} for mongo_id {mongo_id}")
+            return model
+        except Exception as e:
+            logger.warning(f"Gemini context cache creation failed, sending context inline: {str(e)}")
+
+    return genai.GenerativeModel(gemini_model.model_name, system_instruction=system_instruction)
+
+# Helper function to get the model for a document, creating its context cache at most once at a time
+async def get_document_model(mongo_id: str, document: dict) -> genai.GenerativeModel:
+    model = recall_context_model(mongo_id)
+    if model is not None:
+        return model
+
+    task = inflight_context_models.get(mongo_id)
+    if task is None:
+        task = asyncio.create_task(build_document_model(mongo_id, document))
+        inflight_context_models[mongo_id] = task
+        task.add_done_callback(lambda _: inflight_context_models.pop(mongo_id, None))
+    return await asyncio.shield(task)
+
 # Helper function to answer questions with Google Gemini
 async def answer_question(mongo_id: str, question: str) -> str:
+    if not ObjectId.is_valid(mongo_id):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Invalid mongo_id format"
+        )
+
     try:
-        collection = mongo_client[DB_NAME][COLLECTION_NAME]
-        document = await collection.find_one({"_id": ObjectId(mongo_id)})
-        if not document:
-            logger.error(f"No document found for mongo_id: {mongo_id}")
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Document not found"
+        normalized_question = normalize_question(question)
+        cached_answer = recall_answer((mongo_id, normalized_question))
+        if cached_answer is not None:
+            return cached_answer
+
+        # A live context cache means the document exists and its text is already on Gemini's side
+        document_model = recall_context_model(mongo_id)
+        if document_model is None:
+            collection = mongo_client[DB_NAME][COLLECTION_NAME]
+            document = await collection.find_one(
+                {"_id": ObjectId(mongo_id)},
+                projection={"summary": 1, "extracted_text": 1, "extracted_text_gz": 1, "_id": 0}
             )
+            if not document:
+                logger.error(f"No document found for mongo_id: {mongo_id}")
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Document not found"
+                )
+
+        # Only known documents pay for the embedding call and candidate scan
+        cached_answer, embedding = await get_cached_answer(mongo_id, normalized_question)
+        if cached_answer is not None:
+            return cached_answer
+
+        if document_model is None:
+            document_model = await get_document_model(mongo_id, document)
         
-        summary = document.get("summary", "")
-        extracted_text = document.get("extracted_text", "")
-        
-        prompt = f"""
-        Using the following document summary and extracted text, answer the question in 20–30 words:
-        
-        Summary: {summary}  
-        Extracted Text: {extracted_text}
-        
-        Question: {question}
-        
-        Provide a clear, concise answer (20–30 words) in plain text.
-        """
-        
-        response = gemini_model.generate_content(prompt)
+        response = await document_model.generate_content_async(f"Question: {question}\nAnswer in 20–30 words.")
         answer = response.text.strip()
         
         word_count = len(answer.split())
@@ -282,19 +825,24 @@ async def answer_question(mongo_id: str, question: str) -> str:
             logger.warning(f"Answer word count {word_count} outside 20–30 range: {answer}")
             answer = " ".join(answer.split()[:30]) if word_count > 30 else answer
         
+        await cache_answer(mongo_id, question, embedding, answer)
         return answer
     
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error answering question: {str(e)}")
+        if isinstance(e, NotFound):
+            # The context cache expired or was deleted on Gemini's side; rebuild it next time
+            chat_context_models.pop(mongo_id, None)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to answer question: {str(e)}"
         )
 
 # Upload endpoint
-@app.post("/upload", response_model=SummaryResponse)
+# Responses are built as plain dicts; SummaryResponse only documents the schema
+@app.post("/upload", response_model=None, responses={200: {"model": SummaryResponse}})
 async def upload_pdf(file: UploadFile = File(...), background_tasks: BackgroundTasks = None):
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(
@@ -303,47 +851,60 @@ async def upload_pdf(file: UploadFile = File(...), background_tasks: BackgroundT
         )
 
     try:
-        file_content = await file.read()
-        extracted_text = await extract_text_from_pdf(file_content)
-        summary, departments = await process_with_gemini(extracted_text)
-        
-        if not isinstance(summary, str):
-            logger.error(f"Invalid summary type: {type(summary)}, value: {summary}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Invalid summary format returned from Google Gemini"
-            )
-        if not isinstance(departments, list) or not all(isinstance(d, dict) and "name" in d and "email" in d for d in departments):
-            logger.error(f"Invalid departments format: {departments}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Invalid departments format returned from Google Gemini"
+        file_content = await read_upload(file)
+        content_hash = hashlib.sha256(file_content).hexdigest()
+
+        # Re-uploads of an identical PDF reuse the stored result, skipping OCR, Gemini and emails.
+        # Identical uploads arriving while one is still processing wait for its result.
+        existing, claim = await claim_upload(content_hash)
+        if existing is not None:
+            return reused_upload_response(file.filename, existing)
+
+        try:
+            extracted_text = await extract_text_from_pdf(file_content)
+            # Compress the OCR text for storage on a worker thread while Gemini analyzes it;
+            # process_with_gemini has already validated the summary and departments
+            (summary, departments), extracted_text_gz = await asyncio.gather(
+                process_with_gemini(extracted_text),
+                asyncio.to_thread(compress_text, extracted_text)
             )
-        
-        email_data = prepare_email_data(departments, summary, file.filename)
-        if background_tasks:
-            background_tasks.add_task(send_emails_async, email_data)
-        
-        collection = mongo_client[DB_NAME][COLLECTION_NAME]
-        document = {
-            "filename": file.filename,
-            "extracted_text": extracted_text,
-            "summary": summary,
-            "departments": departments,
-            "timestamp": datetime.utcnow(),
-            "email_data": email_data
-        }
-        
-        result = await collection.insert_one(document)
-        
-        response = SummaryResponse(
-            filename=file.filename,
-            departments=departments,
-            summary=summary,
-            mongo_id=str(result.inserted_id)
-        )
-        
-        return response
+            
+            email_data = prepare_email_data(departments, summary, file.filename)
+            document = {
+                "filename": file.filename,
+                "content_hash": content_hash,
+                "extracted_text_gz": extracted_text_gz,
+                "extracted_text_chars": len(extracted_text),
+                "summary": summary,
+                "departments": departments,
+                "timestamp": datetime.now(timezone.utc),
+                "email_data": email_data
+            }
+            
+            try:
+                mongo_id = await save_document(document)
+            except DuplicateKeyError:
+                # Another worker process stored the same PDF first; return its document
+                existing = await mongo_client[DB_NAME][COLLECTION_NAME].find_one(
+                    {"content_hash": content_hash},
+                    projection={"summary": 1, "departments": 1}
+                )
+                if existing is None:
+                    raise
+                release_upload(content_hash, claim, existing)
+                return reused_upload_response(file.filename, existing)
+
+            # Only notify departments once the document is safely stored
+            queue_emails(email_data, background_tasks)
+            release_upload(content_hash, claim, {"_id": mongo_id, "summary": summary, "departments": departments})
+            return ORJSONResponse({
+                "filename": file.filename,
+                "departments": departments,
+                "summary": summary,
+                "mongo_id": str(mongo_id)
+            })
+        finally:
+            release_upload(content_hash, claim)
         
     except HTTPException:
         raise
@@ -372,13 +933,29 @@ async def chat(request: ChatRequest):
         )
     
 @app.get("/all")
-async def get_all_documents(page: int = 1, limit: int = 5):
+async def get_all_documents(
+    page: int = 1,
+    limit: int = 5,
+    before_ts: Optional[datetime] = None,
+    before_id: Optional[str] = None
+):
     """Return paginated documents from the collection.
 
     Query Params:
       page: 1-based page index (default 1)
       limit: page size (default 5, max 50)
+      before_ts, before_id: optional keyset cursor; when before_ts is set, returns
+        the `limit` newest documents ordered after (before_ts, before_id) instead of
+        skipping `page` pages, and `page` is ignored (returned as null). Pass the
+        previous response's `next_before_ts` and `next_before_id` to fetch the next
+        page. Without before_id, documents sharing before_ts exactly are skipped.
     """
+    if before_id is not None and not ObjectId.is_valid(before_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid before_id"
+        )
+
     try:
         if page < 1:
             page = 1
@@ -389,25 +966,45 @@ async def get_all_documents(page: int = 1, limit: int = 5):
 
         collection = mongo_client[DB_NAME][COLLECTION_NAME]
 
-        total = await collection.count_documents({})
-        skip = (page - 1) * limit
+        total = await collection.estimated_document_count()
 
-        cursor = collection.find().sort("timestamp", -1).skip(skip).limit(limit)
+        # Listings only need metadata; full documents are served by /documents/{document_id}
+        projection = {"extracted_text": 0, "extracted_text_gz": 0, "email_data": 0}
+        # _id breaks ties between documents sharing a timestamp so keyset pages never skip any
+        sort = [("timestamp", -1), ("_id", -1)]
+        # Fetch one extra document to know whether another page follows
+        if before_ts is not None:
+            if before_id is not None:
+                query = {"$or": [
+                    {"timestamp": {"$lt": before_ts}},
+                    {"timestamp": before_ts, "_id": {"$lt": ObjectId(before_id)}}
+                ]}
+            else:
+                query = {"timestamp": {"$lt": before_ts}}
+            cursor = collection.find(query, projection=projection).sort(sort).limit(limit + 1)
+        else:
+            skip = (page - 1) * limit
+            cursor = collection.find({}, projection=projection).sort(sort).skip(skip).limit(limit + 1)
         docs = []
         async for doc in cursor:
             doc["_id"] = str(doc["_id"])
             docs.append(doc)
+        more = len(docs) > limit
+        docs = docs[:limit]
 
         total_pages = (total + limit - 1) // limit if limit else 1
+        keyset = before_ts is not None
 
         return {
             "data": docs,
-            "page": page,
+            "page": None if keyset else page,
             "limit": limit,
             "total": total,
             "total_pages": total_pages,
-            "has_next": page < total_pages,
-            "has_prev": page > 1
+            "has_next": more if keyset else page < total_pages,
+            "has_prev": True if keyset else page > 1,
+            "next_before_ts": docs[-1]["timestamp"] if more else None,
+            "next_before_id": docs[-1]["_id"] if more else None
         }
     except Exception as e:
         logger.error(f"Error fetching paginated documents: {str(e)}")
@@ -416,6 +1013,35 @@ async def get_all_documents(page: int = 1, limit: int = 5):
             detail=f"Failed to fetch documents: {str(e)}"
         )
 
+@app.get("/documents/{document_id}")
+async def get_document(document_id: str):
+    """Return a single document, including its extracted text and email data."""
+    if not ObjectId.is_valid(document_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid document id"
+        )
+
+    try:
+        collection = mongo_client[DB_NAME][COLLECTION_NAME]
+        doc = await collection.find_one({"_id": ObjectId(document_id)})
+    except Exception as e:
+        logger.error(f"Error fetching document {document_id}: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch document: {str(e)}"
+        )
+
+    if not doc:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Document not found"
+        )
+    doc["_id"] = str(doc["_id"])
+    doc["extracted_text"] = await asyncio.to_thread(get_extracted_text, doc)
+    doc.pop("extracted_text_gz", None)
+    return doc
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
@@ -432,6 +1058,28 @@ async def health_check():
 # Cleanup on shutdown
 @app.on_event("shutdown")
 async def shutdown_event():
+    if insert_flush_task and not insert_flush_task.done():
+        await insert_queue.put(None)
+        await insert_flush_task
+        logger.info("Insert queue flushed")
+    if email_worker_task and not email_worker_task.done():
+        await email_queue.put(None)
+        await email_worker_task
+        logger.info("Email queue drained")
+    for hostname, smtp in smtp_clients.items():
+        if smtp.is_connected:
+            try:
+                await smtp.quit()
+                logger.info(f"SMTP connection to {hostname} closed")
+            except Exception as e:
+                logger.warning(f"Failed to close SMTP connection to {hostname}: {str(e)}")
+    if chat_context_models:
+        await delete_context_caches([cached_content for cached_content, _, _ in chat_context_models.values()])
+        chat_context_models.clear()
+        logger.info("Gemini context caches deleted")
+    if documentai_client:
+        documentai_client.transport.close()
+        logger.info("Document AI channel closed")
     if mongo_client:
         mongo_client.close()
         logger.info("MongoDB connection closed")